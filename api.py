@@ -1,13 +1,18 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from fastapi import FastAPI
 from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-import inspect
-from typing import Optional, List, Dict, Union
+from starlette.background import BackgroundTask
+from typing import Optional, List, Dict, Literal, Union
 from pydantic import BaseModel
-from pdf import generate_invoice
-from db import SqliteConnector
-from copy import deepcopy
+from pdf import generate_invoice, remove_invoice
+from db import SqliteConnector, close_all
 from mailer import EmailManager
+from operator import itemgetter
 
 app = FastAPI()
 
@@ -22,13 +27,53 @@ origins = [
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=origins,
+    allow_origins=frozenset(origins),
     allow_credentials=True,
-    allow_methods=["POST"],
+    allow_methods=["POST", "OPTIONS"],
     allow_headers=["*"],
 )
 
 
+# A single connector (and so a single SQLite connection) shared by all requests
+sqlite_connector = SqliteConnector("clients.db")
+
+# Invoices are rendered in worker processes, so that generating a PDF (which is
+# CPU-bound) does not hold the GIL of the process serving requests. The workers
+# are spawned rather than forked, as the server is multi-threaded, and there are
+# only a few of them, as they share the CPUs with the server's own threads.
+invoice_workers = 2
+
+
+def create_invoice_executor() -> ProcessPoolExecutor:
+    """
+    Returns a new pool of invoice worker processes.
+    """
+    return ProcessPoolExecutor(
+        max_workers=invoice_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+invoice_executor = create_invoice_executor()
+# Guards replacing invoice_executor when one of its workers has died
+invoice_executor_lock = threading.Lock()
+
+
+@app.on_event("shutdown")
+def close_database_connections() -> None:
+    """
+    Close the shared SQLite connections when the application shuts down.
+    """
+    close_all()
+
+
+@app.on_event("shutdown")
+def shutdown_invoice_executor() -> None:
+    """
+    Stop the invoice worker processes when the application shuts down.
+    """
+    invoice_executor.shutdown()
+
+
 class InvoiceForm(BaseModel):
     first_name: str
     last_name: str
@@ -44,7 +89,7 @@ class InvoiceForm(BaseModel):
     subtotal: str
     email_address: str
     cc_email_address: str
-    method: str
+    method: Literal["download", "email"]
 
 
 class ClientForm(BaseModel):
@@ -54,7 +99,7 @@ class ClientForm(BaseModel):
     address_line_2: Optional[str] = None
     city: str
     post_code: str
-    method: str
+    method: Literal["add", "remove", "search"]
 
 
 # The name and order of columns in the client database
@@ -67,23 +112,8 @@ client_db_row_schema = [
     "post_code",
 ]
 
-
-def get_request_fields(request: InvoiceForm) -> List[str]:
-    """
-    Return a list of fields (json keys) in the  submitted invoice
-    form as a convenience when converting an incoming request to
-    a python dict.
-
-    Arguments:
-    request -- the submitted request with InvoiceForm basemodel whose
-        fields to extract.
-    """
-    dummy = dir(type("dummy", (BaseModel,), {}))
-    fields = []
-    for item in inspect.getmembers(request):
-        if item[0] not in dummy:
-            fields.append(item[0])
-    return fields
+# Extracts a client database row (as a tuple) from a request body
+get_client_db_row = itemgetter(*client_db_row_schema)
 
 
 def strip_emails_from_request(
@@ -108,29 +138,75 @@ def add_client_using_invoice(
     request to a request to add user to the client database
     using the add_client() function.
 
+    The invoice form has already been validated by the /invoice
+    endpoint, so the client data is passed on as a plain dict rather
+    than being re-validated as a ClientForm. Internal callers that do
+    need a ClientForm should use ClientForm.construct() for the same
+    reason.
+
     Arguments:
     client_invoice_form -- information on client submitted by caller.
     """
-    request_body_copy = deepcopy(request_body)
-    del request_body_copy["invoice_number"]
-    request_body_copy["method"] = "add"
-    add_client(request_body_copy)
+    client_request_body = {key: request_body[key] for key in client_db_row_schema}
+    client_request_body["method"] = "add"
+    add_client(client_request_body)
+
+
+def render_invoice(request_body: Dict[str, Union[str, List[Dict[str, str]]]]) -> str:
+    """
+    Generate an invoice in one of the invoice worker processes, wait
+    for it to finish and return the absolute path of the saved invoice.
+
+    Arguments:
+    request_body -- information on client submitted by caller.
+    """
+    executor = invoice_executor
+    try:
+        return executor.submit(generate_invoice, request_body).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. was killed for running out of memory), which
+        # breaks the whole pool, so replace it and try once more
+        executor = replace_invoice_executor(executor)
+        return executor.submit(generate_invoice, request_body).result()
+
+
+def replace_invoice_executor(
+    broken_executor: ProcessPoolExecutor,
+) -> ProcessPoolExecutor:
+    """
+    Replace a broken pool of invoice worker processes with a new one and
+    return it. If another thread has already replaced it, the pool that
+    thread created is returned instead.
+
+    Arguments:
+    broken_executor -- the pool that could no longer run invoices.
+    """
+    global invoice_executor
+    with invoice_executor_lock:
+        if invoice_executor is broken_executor:
+            broken_executor.shutdown(wait=False)
+            invoice_executor = create_invoice_executor()
+        return invoice_executor
 
 
 def download_invoice(
     request_body: Dict[str, Union[str, List[Dict[str, str]]]]
 ) -> FileResponse:
     """
-    Returns a pdf file of an invoice.
+    Returns a pdf file of an invoice. The file is stat-ed here, in the
+    worker thread, rather than in the event loop, and is deleted once it
+    has been sent.
 
     Arguments:
     request_body -- information on client submitted by caller.
     """
     strip_emails_from_request(request_body)
-    invoice_file_path = generate_invoice(request_body)
+    invoice_file_path = render_invoice(request_body)
     return FileResponse(
         invoice_file_path,
         media_type="application/pdf",
+        stat_result=os.stat(invoice_file_path),
+        background=BackgroundTask(remove_invoice, invoice_file_path),
     )
 
 
@@ -142,14 +218,21 @@ def email_invoice(request_body: Dict[str, Union[str, List[Dict[str, str]]]]) ->
     }
     email_manager = EmailManager(invoice_meta)
     strip_emails_from_request(request_body)
-    invoice_file_path = generate_invoice(request_body)
-    message = email_manager.construct_email(invoice_file_path)
+    invoice_file_path = render_invoice(request_body)
+    try:
+        message = email_manager.construct_email(invoice_file_path)
+    finally:
+        remove_invoice(invoice_file_path)
     success = email_manager.send_email(message)
     return {"success": success}
 
 
+# Maps each InvoiceForm method to the function handling it
+invoice_method_routes = {"download": download_invoice, "email": email_invoice}
+
+
 @app.post("/invoice")
-async def root(
+def root(
     client_invoice_form: InvoiceForm,
 ) -> Union[Dict[str, bool], FileResponse]:
     """
@@ -163,34 +246,26 @@ async def root(
     Create a dictionary out of client_invoice_form
     as this keeps pdf.py independent of BaseModel (fastapi)
     """
-    request_fields = get_request_fields(client_invoice_form)
-    request_body = {
-        request_field: getattr(client_invoice_form, request_field)
-        for request_field in request_fields
-    }
+    request_body = client_invoice_form.dict()
 
     add_client_using_invoice(request_body)
 
-    method_routes = {"download": download_invoice, "email": email_invoice}
-
-    method = request_body["method"]
-    del request_body["method"]
-    return method_routes[method](request_body)
+    method = request_body.pop("method")
+    return invoice_method_routes[method](request_body)
 
 
 def add_client(request_body: Dict[str, Union[str, List[Dict[str, str]]]]) -> None:
     """
     Add a row matching the data in request_body into
-    the address table in the client database.
+    the address table in the client database. request_body
+    is trusted to have been validated already, either by the
+    /client endpoint or by the caller.
 
     Arguments:
     request_body -- information on client to add
         submitted by the caller.
     """
-    sqlite_connector = SqliteConnector("clients.db")
-    sqlite_connector.enter_address(
-        tuple(request_body[key] for key in client_db_row_schema)
-    )
+    sqlite_connector.enter_address(get_client_db_row(request_body))
 
 
 def remove_client(
@@ -204,10 +279,7 @@ def remove_client(
     request_body -- information on client to remove
         submitted by the caller.
     """
-    sqlite_connector = SqliteConnector("clients.db")
-    success = sqlite_connector.remove_address(
-        tuple(request_body[key] for key in client_db_row_schema)
-    )
+    success = sqlite_connector.remove_address(get_client_db_row(request_body))
 
     return {"success": success}
 
@@ -225,17 +297,23 @@ def search_client(
     request_body -- information on client to search for
         submitted by the caller.
     """
-    sqlite_connector = SqliteConnector("clients.db")
-
     results = sqlite_connector.search_address(
         request_body["first_name"], request_body["last_name"]
     )
 
-    return [{key: row[key] for key in row.keys()} for row in results]
+    return [dict(row) for row in results]
+
+
+# Maps each ClientForm method to the function handling it
+client_method_routes = {
+    "add": add_client,
+    "remove": remove_client,
+    "search": search_client,
+}
 
 
 @app.post("/client")
-async def root(
+def root(
     client_action_form: ClientForm,
 ) -> Union[Dict[str, bool], List[Dict[str, str]]]:
     """
@@ -246,18 +324,7 @@ async def root(
         submitted by the caller.
     """
 
-    request_fields = get_request_fields(client_action_form)
-    request_body = {
-        request_field: getattr(client_action_form, request_field)
-        for request_field in request_fields
-    }
-
-    method_routes = {
-        "add": add_client,
-        "remove": remove_client,
-        "search": search_client,
-    }
+    request_body = client_action_form.dict()
 
-    method = request_body["method"]
-    del request_body["method"]
-    return method_routes[method](request_body)
+    method = request_body.pop("method")
+    return client_method_routes[method](request_body)
@@ -1,7 +1,90 @@
 import os
 import sqlite3
+import threading
 from sqlite3 import Row
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple
+
+# The directory containing the SQLite database files, resolved once at import.
+_DB_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "db")
+
+# Connections shared by every SqliteConnector, keyed by database file name.
+_CONNECTIONS: Dict[str, sqlite3.Connection] = {}
+
+# Serialises use of the shared connections, which are used from the threads
+# that FastAPI runs the (synchronous) endpoints in, so that one request's
+# statement and commit are never interleaved with another's.
+_LOCK = threading.Lock()
+
+# Applied once to every new connection: WAL lets readers run alongside the
+# writer, and synchronous=NORMAL drops the per-commit fsync that WAL makes
+# unnecessary for durability against application crashes.
+_CONNECTION_PRAGMAS = [
+    "pragma journal_mode=WAL",
+    "pragma synchronous=NORMAL",
+    "pragma journal_size_limit=67108864",
+    "pragma temp_store=MEMORY",
+    "pragma mmap_size=268435456",
+    "pragma cache_size=-20000",
+]
+
+# The SQL statements used by SqliteConnector.
+_SQL_SEARCH = """
+    select
+        *
+    from
+        address
+    where
+        first_name=?
+        and last_name=?
+    """
+
+_SQL_INSERT = """
+    insert or ignore into
+        address
+    values
+        (?,?,?,?,?,?)
+    """
+
+_SQL_DELETE = """
+    delete from
+        address
+    where
+        first_name=?
+        and last_name=?
+        and address_line_1=?
+        and address_line_2=?
+        and city=?
+        and post_code=?
+    """
+
+
+def get_connection(db_name: str) -> sqlite3.Connection:
+    """
+    Returns the process-wide connection to the SQLite3 database file with the
+    given name, opening it on first use. Must be called with _LOCK held.
+
+    Arguments:
+        db_name -- the name of the SQLite database file to connect to.
+    """
+    con = _CONNECTIONS.get(db_name)
+    if con is None:
+        con = sqlite3.connect(os.path.join(_DB_DIR, db_name), check_same_thread=False)
+        con.row_factory = Row
+        for pragma in _CONNECTION_PRAGMAS:
+            con.execute(pragma)
+        _CONNECTIONS[db_name] = con
+    return con
+
+
+def close_all() -> None:
+    """
+    Closes every connection opened by get_connection. Intended to be called
+    once when the application shuts down.
+    """
+    with _LOCK:
+        while _CONNECTIONS:
+            _, con = _CONNECTIONS.popitem()
+            con.close()
 
 
 class SqliteConnector:
@@ -10,7 +93,8 @@ class SqliteConnector:
 
     Attributes:
         db_name -- the name of the SQLite database file to connect to.
-        con -- the sqlite3 object representing the connection to the database.
+        con -- the sqlite3 object representing the connection to the database,
+            looked up on each use, as it is shared with other instances.
 
     Methods:
         __init__
@@ -18,6 +102,7 @@ class SqliteConnector:
         close_db
         search_address
         enter_address
+        enter_addresses
         remove_address
     """
 
@@ -26,25 +111,33 @@ class SqliteConnector:
         Initialise a new instance of SqliteConnector.
         """
         self.db_name = db_name
-        self.con = self.open_db()
-        self.con.row_factory = Row
+        with _LOCK:
+            self.open_db()
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        """
+        The shared connection to the SQLite3 database used by this object,
+        reopened if it has been closed. Must be used with _LOCK held.
+        """
+        return self.open_db()
 
     def open_db(self):
         """
-        Opens a connection to the SQLite3 database file pointed to by
-        the db_name attribute.
+        Returns the shared connection to the SQLite3 database file pointed to
+        by the db_name attribute.
         """
-        application_path = os.path.dirname(os.path.realpath(__file__))
-        return sqlite3.connect(
-            application_path + os.path.sep + "db" + os.path.sep + self.db_name
-        )
+        return get_connection(self.db_name)
 
     def close_db(self):
         """
-        Closes the connection to the SQLite3 database opened when the object
-        of this class was instantiated.
+        Closes the shared connection to the SQLite3 database used by this
+        object. Other instances will transparently reopen it on next use.
         """
-        self.con.close()
+        with _LOCK:
+            con = _CONNECTIONS.pop(self.db_name, None)
+            if con is not None:
+                con.close()
 
     def search_address(self, first_name: str, last_name: str) -> List[Row]:
         """
@@ -55,20 +148,10 @@ class SqliteConnector:
             first_name -- the first name of the client whose address to search for.
             last_name -- the last name of the client whose address to search for.
         """
-        cur = self.con.cursor()
-        result = cur.execute(
-            """
-            select
-                *
-            from
-                address
-            where
-                first_name=?
-                and last_name=?
-            """,
-            (first_name, last_name),
-        )
-        return list(result)
+        with _LOCK:
+            cur = self.con.cursor()
+            cur.execute(_SQL_SEARCH, (first_name, last_name))
+            return cur.fetchall()
 
     def enter_address(self, row: Tuple[str]) -> None:
         """
@@ -77,47 +160,33 @@ class SqliteConnector:
         Arguments:
             row -- a tuple containing the data that will fill the new row.
         """
-        cur = self.con.cursor()
-        cur.execute(
-            """
-            insert or ignore into 
-                address
-            values
-                (?,?,?,?,?,?)
-            """,
-            row,
-        )
-        self.con.commit()
+        with _LOCK:
+            cur = self.con.cursor()
+            cur.execute(_SQL_INSERT, row)
+            self.con.commit()
+
+    def enter_addresses(self, rows: Iterable[Tuple[str]]) -> None:
+        """
+        Enters several new rows into the address table in a single
+        transaction, so that they share one commit.
+
+        Arguments:
+            rows -- an iterable of tuples, each containing the data that will
+                fill one new row.
+        """
+        with _LOCK, self.con:
+            self.con.executemany(_SQL_INSERT, rows)
 
-    def remove_address(self, row: Tuple[str]) -> None:
+    def remove_address(self, row: Tuple[str]) -> bool:
         """
-        Removes a row from the address table, returns a dict containing the success
-        state of the operation.
+        Removes a row from the address table, returns True if a row was
+        removed and False otherwise.
 
         Arguments:
             row -- the row of data to remove.
         """
-        cur = self.con.cursor()
-        cur.execute("select count(*) from address")
-        row_count_pre = cur.fetchone()[0]
-
-        cur.execute(
-            """
-            delete from
-                address
-            where
-                first_name=?
-                and last_name=?
-                and address_line_1=?
-                and address_line_2=?
-                and city=?
-                and post_code=?
-            """,
-            row,
-        )
-        self.con.commit()
-
-        cur.execute("select count(*) from address")
-        row_count_post = cur.fetchone()[0]
-
-        return not (row_count_pre == row_count_post)
+        with _LOCK:
+            cur = self.con.cursor()
+            cur.execute(_SQL_DELETE, row)
+            self.con.commit()
+            return cur.rowcount > 0
@@ -1,15 +1,209 @@
 import json
+import logging
 import os
+import threading
+import time
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Dict, Optional
+from string import Formatter
+from typing import Dict, List, Optional, Tuple
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 from utility import format_uk_date, generate_absolute_path
 
+logger = logging.getLogger(__name__)
+
+
+def read_company_file() -> Dict[str, str]:
+    """
+    Reads the file representing the company controlling the instance of
+    outvoice (name, email address).
+    """
+    company_file_path = generate_absolute_path("/resources/company/company.json")
+    with open(company_file_path) as company_file:
+        return json.load(company_file)
+
+
+def read_field_templates() -> Dict[str, str]:
+    """
+    Reads the unformatted html body, text body, subject and sender from files
+    with fixed, predetermined locations into a dictionary.
+    """
+    fields = {"text_body": "", "html_body": "", "subject": "", "sender": ""}
+    for field in fields:
+        file_path = generate_absolute_path(f"/resources/email/{field}")
+        with open(file_path, "r") as file:
+            fields[field] = file.read()
+    return fields
+
+
+def split_template(template: str) -> List[Tuple[str, Optional[str]]]:
+    """
+    Splits a str.format-style template into a list of (literal text,
+    placeholder name) pairs, where the placeholder name is None for
+    trailing text. Only plain {name} placeholders are supported.
+
+    Arguments:
+    template -- the template to split.
+    """
+    return [
+        (literal_text, field_name)
+        for literal_text, field_name, _, _ in Formatter().parse(template)
+    ]
+
+
+# The company file and email templates are read (and the templates split) once
+# when the module is imported
+_COMPANY = read_company_file()
+_FIELD_TEMPLATES = read_field_templates()
+_FIELD_TEMPLATE_PARTS = {
+    field: split_template(template) for field, template in _FIELD_TEMPLATES.items()
+}
+
+
+def fill_template(field: str, **values: str) -> str:
+    """
+    Returns the template for the given email field with its placeholders
+    replaced by the supplied values.
+
+    Arguments:
+    field -- the email field (subject, html body, ...) whose template to fill.
+    values -- the value to substitute for each placeholder name.
+    """
+    return "".join(
+        literal_text + (values[field_name] if field_name is not None else "")
+        for literal_text, field_name in _FIELD_TEMPLATE_PARTS[field]
+    )
+
+
+# A single SES client (and its pool of HTTPS connections) shared by every
+# EmailManager, as creating a client per email is slow. Adaptive retries back
+# off exponentially and rate limit the client when SES throttles sends.
+_SES_CLIENT = boto3.client(
+    "ses",
+    region_name="eu-central-1",
+    config=Config(
+        max_pool_connections=50, retries={"max_attempts": 5, "mode": "adaptive"}
+    ),
+)
+
+# SES error codes that mean a send may succeed later. The client retries these
+# itself, so send_email only sees them once its retries are exhausted; any
+# other error (e.g. MessageRejected) means the email will never be accepted.
+transient_error_codes = frozenset(
+    ["Throttling", "TooManyRequestsException", "ServiceUnavailable"]
+)
+
+
+class SendRateLimiter:
+    """
+    A thread-safe token bucket that paces emails to the maximum send rate of
+    the SES account, which is read from SES the first time an email is sent.
+    Reading the rate needs the ses:GetSendQuota permission as well as
+    ses:SendRawEmail. Until the rate has been read (or if it cannot be read),
+    emails are not paced, leaving throttling to the SES client's adaptive
+    retries, and the rate is read again every quota_retry_interval seconds.
+
+    Attributes:
+        ses_client: the interface to the AWS SES API in Python.
+        rate: the maximum number of emails to send per second, or None if
+            emails are not being paced.
+        rate_expires: the time (time.monotonic) to read the rate at next, or
+            None if the rate has been read from SES.
+        tokens: the number of emails that can currently be sent without
+            waiting, negative if sends are already waiting for tokens.
+        last_refill: the time (time.monotonic) tokens were last added.
+    """
+
+    # How long to send emails without pacing before reading the quota again
+    # (seconds)
+    quota_retry_interval = 300.0
+
+    def __init__(self, ses_client):
+        self.ses_client = ses_client
+        self.rate = None
+        self.rate_expires = 0.0
+        self.tokens = 0.0
+        self.last_refill = 0.0
+        self.lock = threading.Lock()
+
+    def read_rate(self) -> Optional[float]:
+        """
+        Returns the maximum number of emails per second the SES account may
+        send, or None if it could not be read or is not positive.
+        """
+        try:
+            rate = float(self.ses_client.get_send_quota()["MaxSendRate"])
+        except (ClientError, BotoCoreError) as e:
+            logger.warning(
+                "Could not read the SES send quota, sending emails without pacing "
+                "for the next %s seconds: %s",
+                self.quota_retry_interval,
+                e,
+            )
+            return None
+        if rate <= 0:
+            logger.warning(
+                "The SES send quota has a MaxSendRate of %s, sending emails "
+                "without pacing for the next %s seconds",
+                rate,
+                self.quota_retry_interval,
+            )
+            return None
+        return rate
+
+    def update_rate(self) -> None:
+        """
+        Reads the send rate from SES if it is due to be read. The read is
+        made without holding the lock, and by one thread at a time.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.rate_expires is None or now < self.rate_expires:
+                return
+            # Claim the read, so that other threads do not also make it
+            self.rate_expires = now + self.quota_retry_interval
+        rate = self.read_rate()
+        with self.lock:
+            if rate is None:
+                self.rate = None
+                return
+            if self.rate is None:
+                # Start with a full bucket
+                self.tokens = rate
+                self.last_refill = time.monotonic()
+            self.rate = rate
+            self.rate_expires = None
+
+    def acquire(self) -> None:
+        """
+        Blocks until an email can be sent without exceeding the send rate.
+        The next token is reserved under the lock, and the wait for it happens
+        outside the lock, so that sends waiting for tokens queue up in order
+        without blocking each other.
+        """
+        self.update_rate()
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(
+                max(self.rate, 1.0), self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Paces the emails sent through the shared SES client
+_SEND_RATE_LIMITER = SendRateLimiter(_SES_CLIENT)
+
 
 class EmailManager:
     """
@@ -35,19 +229,17 @@ class EmailManager:
 
     def init_ses_client(self):
         """
-        Returns an interface to SES.
+        Returns the interface to SES shared by all instances.
         """
-        return boto3.client("ses", region_name="eu-central-1")
+        return _SES_CLIENT
 
-    def init_sender(self) -> None:
+    def init_sender(self) -> Dict[str, str]:
         """
         Initialises a dict containing information on the sender
-        (name, email address) from a file representing the company controlling
-        the instance of outvoice.
+        (name, email address) from the file representing the company controlling
+        the instance of outvoice, as read when this module was imported.
         """
-        company_file_path = generate_absolute_path("/resources/company/company.json")
-        with open(company_file_path) as company_file:
-            return json.load(company_file)
+        return dict(_COMPANY)
 
     def init_fields(self) -> Dict[str, str]:
         """
@@ -59,17 +251,12 @@ class EmailManager:
         self.format_sender(fields)
         return fields
 
-    def read_fields(self) -> str:
+    def read_fields(self) -> Dict[str, str]:
         """
-        Reads the html body, subject and sender from a file with fixed,
-        predetermined location into a dictionary.
+        Returns a copy of the unformatted html body, text body, subject and
+        sender, as read when this module was imported.
         """
-        fields = {"text_body": "", "html_body": "", "subject": "", "sender": ""}
-        for field in fields:
-            file_path = generate_absolute_path(f"/resources/email/{field}")
-            with open(file_path, "r") as file:
-                fields[field] = file.read()
-        return fields
+        return dict(_FIELD_TEMPLATES)
 
     def format_body(self, fields: Dict[str, str]) -> None:
         """
@@ -82,7 +269,8 @@ class EmailManager:
             necessary to address the client.
         """
         for body_type in ["text_body", "html_body"]:
-            fields[body_type] = fields[body_type].format(
+            fields[body_type] = fill_template(
+                body_type,
                 first_name=self.invoice_meta["first_name"],
                 sender=self.sender["company_name"],
                 invoice_date=format_uk_date(self.invoice_meta["invoice_date"]),
@@ -96,7 +284,7 @@ class EmailManager:
         Arguments:
         fields -- a dict containing the contents of the email.
         """
-        fields["subject"] = fields["subject"].format(sender=self.sender["company_name"])
+        fields["subject"] = fill_template("subject", sender=self.sender["company_name"])
 
     def format_sender(self, fields: Dict[str, str]) -> None:
         """
@@ -106,8 +294,8 @@ class EmailManager:
         Arguments:
         fields -- a dict containing the contents of the email.
         """
-        fields["sender"] = fields["sender"].format(
-            sender=self.sender["company_name"], email=self.sender["email"]
+        fields["sender"] = fill_template(
+            "sender", sender=self.sender["company_name"], email=self.sender["email"]
         )
 
     def construct_email_meta(self, message: MIMEMultipart) -> None:
@@ -138,7 +326,8 @@ class EmailManager:
         body.attach(MIMEText(self.fields["html_body"], "html", "utf-8"))
         body.attach(MIMEText(self.fields["text_body"], "text", "utf-8"))
         message.attach(body)
-        attachment = MIMEApplication(open(invoice_file_path, "rb").read())
+        with open(invoice_file_path, "rb") as invoice_file:
+            attachment = MIMEApplication(invoice_file.read(), _subtype="pdf")
         attachment.add_header(
             "Content-Disposition",
             "attachment",
@@ -161,13 +350,22 @@ class EmailManager:
         message -- the multipart MIME email to send.
         """
         try:
+            _SEND_RATE_LIMITER.acquire()
             response = self.ses_client.send_raw_email(
                 Source=self.sender["email"],
                 Destinations=[self.invoice_meta["email_address"]],
-                RawMessage={"Data": message.as_string()},
+                RawMessage={"Data": message.as_bytes()},
             )
             if "MessageId" in response:
                 return True
         except ClientError as e:
-            print(e)
+            code = e.response.get("Error", {}).get("Code")
+            if code in transient_error_codes:
+                logger.warning("Sending email failed after retrying (%s): %s", code, e)
+            else:
+                logger.error("Sending email was rejected (%s): %s", code, e)
+            return False
+        except BotoCoreError as e:
+            # Raised without a response from SES, e.g. if it could not be reached
+            logger.error("Sending email failed: %s", e)
             return False
@@ -1,7 +1,14 @@
 import io
+import math
+import os
+import shutil
+import tempfile
 from copy import copy
+from decimal import ROUND_HALF_UP, Decimal
+from functools import lru_cache
+from itertools import islice
 from json import load
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 from PyPDF2 import PdfFileReader, PdfFileWriter
 from PyPDF2.pdf import PageObject
@@ -30,114 +37,141 @@ def write_page_to_file(page: PageObject, output_file_path: str) -> None:
     output_stream.close()
 
 
+@lru_cache(maxsize=4)
+def read_file_bytes(input_file_path: str) -> bytes:
+    """
+    Read the contents of a file. The file is only read the first time,
+    later calls return the cached contents.
+
+    Arguments:
+    input_file_path -- absolute path of the file to read
+    """
+    with open(input_file_path, "rb") as input_file:
+        return input_file.read()
+
+
 def read_first_page(input_file_path: str) -> PageObject:
     """
-    Read the first page from an existing PDF document.
+    Read the first page from an existing PDF document. The document is
+    parsed from a copy of it cached in memory, so it is only read from
+    disk once.
 
     Arguments:
     input_file_path -- absolute path to save PDF
     """
-    in_ = PdfFileReader(open(input_file_path, "rb"))
+    in_ = PdfFileReader(io.BytesIO(read_file_bytes(input_file_path)))
     return in_.getPage(0)
 
 
-def write_text_to_overlay(
-    line: str,
-    text: PDFTextObject,
-    layout: Dict[str, Union[str, Dict[str, str]]],
-    x_offset: Optional[float] = 0,
-    y_offset: Optional[float] = 0,
-) -> None:
+# A line of text to write on an overlay: the text, the layout entry giving its
+# position (points), font and size, and a vertical offset (points) from that position
+OverlayText = Tuple[str, Dict[str, Union[str, float]], float]
+
+
+def write_texts_to_overlay(texts: List[OverlayText], text: PDFTextObject) -> None:
     """
-    Write the text at the given position, with a given font and size. Modifies the
-    passed PDFTextObject (text) in place and does not return a value.
+    Write each line of text at its position, with its font and size. The lines are
+    written in order, and the font is only set when it changes from the last line's.
+    Modifies the passed PDFTextObject (text) in place and does not return a value.
+    Text is only split into lines if it contains more than one, and
+    leading and trailing whitespace is stripped from every line.
 
     Arguments:
-        line -- the line of text to to write.
-        text -- the reportlab PDFTextObject object attached to the overlay canvas.
-        layout -- a dict that contains the following fields:
-            x_origin -- the x position (mm) to start the text at on the overlay.
-            y_origin -- the y position (mm) to start the text at on the overlay.
+        texts -- the lines of text to write, each with a layout entry that contains
+            the following fields:
+            x_origin -- the x position (points) to start the text at on the overlay.
+            y_origin -- the y position (points) to start the text at on the overlay.
             font -- the font to use for the text to write.
             size -- the size of the text to write.
+        text -- the reportlab PDFTextObject object attached to the overlay canvas.
     """
-    x, y = layout["x_origin"] + x_offset, layout["y_origin"] + y_offset
-    text.setFont(layout["font"], layout["size"])
-    text.setTextOrigin(x * mm, y * mm)
-    text.textLines(line)
+    font = None
+    for line, layout, y_offset in texts:
+        if font != (layout["font"], layout["size"]):
+            font = (layout["font"], layout["size"])
+            text.setFont(*font)
+        text.setTextOrigin(layout["x_origin"], layout["y_origin"] + y_offset)
+        if "\n" in line:
+            text.textLines(line)
+        else:
+            # Strip the line and end it, as textLines does
+            text.textLine(line.strip())
+
 
+# Amounts are shown to the penny, with halves of a penny rounded up (away from zero)
+penny = Decimal("0.01")
 
-def format_currency_string(string_to_format: str, currency_symbol: str) -> str:
+
+def format_currency_string(number_to_format: Decimal, currency_symbol: str) -> str:
     """
-    Formats a given string representing a decimal number and
-    return it represented with two decimal points and a given
-    currency symbol.
+    Formats a given decimal number and return it represented
+    with two decimal points and a given currency symbol.
 
     Arguments:
-    string_to_format -- the string to format.
+    number_to_format -- the number to format.
     """
-    return f"{currency_symbol}{float(string_to_format):.2f}"
+    return f"{currency_symbol}{format_quantity_string(number_to_format)}"
 
 
-def format_quantity_string(string_to_format: str) -> str:
+def format_quantity_string(number_to_format: Decimal) -> str:
     """
-    Formats a given string representing a decimal number and
-    return it represented with two decimal points.
+    Formats a given decimal number and return it represented
+    with two decimal points, rounding halves up.
 
     Arguments:
-    string_to_format -- the string to format.
+    number_to_format -- the number to format.
     """
-    return f"{float(string_to_format):.2f}"
+    return str(number_to_format.quantize(penny, rounding=ROUND_HALF_UP))
 
 
-def add_tax_and_balance(invoice_form: dict):
+def parse_invoice_form_numbers(
+    invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
+) -> None:
     """
-    Calculate the payable tax using the (decimal) tax rate in the
-    invoice form dictionary and the corresponding total amount to pay.
+    Convert the strings representing the tax rate, subtotal and cost
+    of each line item to Decimals in-place, so that each is parsed once
+    and the arithmetic on these amounts is exact.
 
     Arguments:
     invoice_form -- data about the client passed from
         the API end-point.
     """
-    invoice_form["tax"] = str(
-        float(invoice_form["tax"]) * float(invoice_form["subtotal"])
-    )
-    invoice_form["balance"] = str(
-        float(invoice_form["tax"]) + float(invoice_form["subtotal"])
-    )
+    invoice_form["tax"] = Decimal(invoice_form["tax"])
+    invoice_form["subtotal"] = Decimal(invoice_form["subtotal"])
+    for line_item in invoice_form["line_items"]:
+        line_item["cost_per_item"] = Decimal(line_item["cost_per_item"])
 
 
-def add_line_items_amount(
-    invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
-) -> None:
+def add_tax_and_balance(invoice_form: dict):
     """
-    Calculate the amount due for each line item and add these values
-    to the line_items dictionary in the invoice form dictionary.
+    Calculate the payable tax using the (decimal) tax rate in the
+    invoice form dictionary and the corresponding total amount to pay.
 
     Arguments:
     invoice_form -- data about the client passed from
         the API end-point.
     """
-    for line_item in invoice_form["line_items"]:
-        cost_per_item = float(line_item["cost_per_item"])
-        count = float(line_item["count"])
-        line_item["amount"] = f"{(cost_per_item * count):.2f}"
+    invoice_form["tax"] = invoice_form["tax"] * invoice_form["subtotal"]
+    invoice_form["balance"] = invoice_form["tax"] + invoice_form["subtotal"]
 
 
-def format_line_items(
+def add_line_items_amount(
     invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
 ) -> None:
     """
-    Formats the strings included in the each of the dicts in the
-    line items array.
+    Calculate the amount due for each line item and add these values
+    to the line_items dictionary in the invoice form dictionary,
+    formatting the cost per item of each line item in the same pass.
 
     Arguments:
     invoice_form -- data about the client passed from
         the API end-point.
     """
     for line_item in invoice_form["line_items"]:
-        cost_per_item = format_quantity_string(line_item["cost_per_item"])
-        line_item["cost_per_item"] = cost_per_item
+        cost_per_item = line_item["cost_per_item"]
+        amount = cost_per_item * Decimal(line_item["count"])
+        line_item["amount"] = format_quantity_string(amount)
+        line_item["cost_per_item"] = format_quantity_string(cost_per_item)
 
 
 def format_subtotal_tax_and_balance(
@@ -174,22 +208,21 @@ def format_address_line(
     invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
 ) -> None:
     """
-    Add formatted address line to invoice_form in-place.
+    Add formatted address line to invoice_form in-place. Empty lines
+    (e.g. an unused address_line_2) are left out.
 
     Arguments:
     invoice_form -- data about the client passed from
         the API end-point.
     """
-    address = [
-        invoice_form["first_name"] + " " + invoice_form["last_name"],
+    address = (
+        f"{invoice_form['first_name']} {invoice_form['last_name']}",
         invoice_form["address_line_1"],
+        invoice_form.get("address_line_2"),
         invoice_form["city"],
         invoice_form["post_code"],
-    ]
-    address_line_2 = invoice_form.get("address_line_2", "")
-    if address_line_2:
-        address.insert(2, address_line_2)
-    invoice_form["address"] = "\n".join(address)
+    )
+    invoice_form["address"] = "\n".join(line for line in address if line)
 
 
 def format_terms_line(
@@ -205,27 +238,33 @@ def format_terms_line(
     invoice_form["terms"] = f"Pay on or before {invoice_form['pay_date']}."
 
 
+# The keys of the invoice form that are only used to generate formatted output
+# strings, and so are not written to the invoice themselves
+unused_keys = (
+    "first_name",
+    "last_name",
+    "address_line_1",
+    "address_line_2",
+    "city",
+    "post_code",
+    "pay_date",
+)
+
+
 def delete_unused_keys(
     invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
 ) -> None:
     """
     Delete the keys (in-place) that are no longer used as
-    a result of generating formatted output strings.
+    a result of generating formatted output strings. Keys
+    missing from invoice_form (e.g. address_line_2) are ignored.
 
     Arguments:
     invoice_form -- data about the client passed from
         the API end-point.
     """
-    for key in [
-        "first_name",
-        "last_name",
-        "address_line_1",
-        "address_line_2",
-        "city",
-        "post_code",
-        "pay_date",
-    ]:
-        del invoice_form[key]
+    for key in unused_keys:
+        invoice_form.pop(key, None)
 
 
 def format_invoice_form_input(
@@ -239,9 +278,9 @@ def format_invoice_form_input(
     invoice_form -- data about the client passed from
         the API end-point.
     """
+    parse_invoice_form_numbers(invoice_form)
     add_tax_and_balance(invoice_form)
     add_line_items_amount(invoice_form)
-    format_line_items(invoice_form)
     format_subtotal_tax_and_balance(invoice_form)
     format_address_line(invoice_form)
     format_invoice_form_dates(invoice_form)
@@ -249,111 +288,172 @@ def format_invoice_form_input(
     delete_unused_keys(invoice_form)
 
 
-def write_line_items(
-    text: PDFTextObject, line_items: List[Dict[str, str]], layout: Dict[str, str]
-) -> None:
+# The vertical distance between consecutive line items (points)
+line_item_spacing = 5 * mm
+
+
+def generate_line_item_texts(
+    line_items: List[Dict[str, str]], layout: Dict[str, str]
+) -> List[OverlayText]:
     """
-    Write a given array of line items to the supplied text object (invoice page).
+    Returns the lines of text needed to write a given array of line
+    items on an invoice page, one line item at a time, each below the
+    previous one.
 
     Arguments:
-    text -- the reportlab PDFTextObject object attached to the overlay canvas.
     line_items -- the array of line items to write.
     layout -- a dict containing information on position and style of text.
     """
-    line_item_offset = 0
-    for line_item in line_items:
-        for key in line_item:
-            write_text_to_overlay(
-                line_item[key], text, layout[key], y_offset=line_item_offset
-            )
-        line_item_offset -= 5
+    return [
+        (line_item[key], layout[key], -i * line_item_spacing)
+        for i, line_item in enumerate(line_items)
+        for key in line_item
+    ]
 
 
-def write_page_number(
-    text: PDFTextObject,
+def generate_page_number_texts(
     page_number: int,
     total_pages: int,
     layout: Dict[str, Dict[str, str]],
-) -> None:
+) -> List[OverlayText]:
     """
-    Write a page number and (if necessary) a 'turnover prompt' to
-    the supplied text object (invoice page)
+    Returns the lines of text needed to write a page number and (if
+    necessary) a 'turnover prompt' on an invoice page.
 
     Arguments:
-    text -- the reportlab PDFTextObject object attached to the overlay canvas.
     page_number -- the number of the page being written on.
     total_pages -- the total number of pages in the invoice.
-    layout -- a dict that contains the following fields:
-            x_origin -- the x position (mm) to start the text at on the overlay.
-            y_origin -- the y position (mm) to start the text at on the overlay.
-            font -- the font to use for the text to write.
-            size -- the size of the text to write.
+    layout -- a dict containing information on position and style of text.
     """
     page_number_line = f"Page {page_number + 1} of {total_pages}"
-    write_text_to_overlay(page_number_line, text, layout["page_number_line"])
+    texts = [(page_number_line, layout["page_number_line"], 0)]
     if page_number + 1 < total_pages:
         turn_over_line = "(Invoice continues overleaf)"
-        write_text_to_overlay(turn_over_line, text, layout["turn_over_line"])
+        texts.append((turn_over_line, layout["turn_over_line"], 0))
+    return texts
 
 
-def generate_invoice_overlay(
+def write_invoice_overlay_page(
+    invoice_layer_canvas: canvas.Canvas,
     invoice_form: Dict[str, str],
+    line_items: List[Dict[str, str]],
     layout: Dict[str, str],
     page_number: int,
     total_pages: int,
-) -> PageObject:
+) -> None:
     """
-    Create a PDF page (overlay) of invoice information
-    that can be rendered on top of a blank invoice page.
+    Draw a page (overlay) of invoice information that can be rendered
+    on top of a blank invoice page onto the supplied canvas, then start
+    a new page on the canvas.
 
     Arguments:
+    invoice_layer_canvas -- the reportlab canvas to draw the page on.
     invoice_form -- data about the client passed from
         the API end-point.
+    line_items -- the line items to write on this page, in place of
+        the line items in invoice_form.
+    layout -- a dict containing information on position and style of text.
+    page_number -- the number of the page being written on.
+    total_pages -- the total number of pages in the invoice.
     """
-    packet = io.BytesIO()
-    invoice_layer_canvas = canvas.Canvas(packet)
-    invoice_layer_canvas.setPageSize((A4))
-    text = invoice_layer_canvas.beginText()
-
+    texts = []
     for field in invoice_form:
         if field == "line_items":
-            write_line_items(text, invoice_form["line_items"], layout["line_items"])
+            texts.extend(generate_line_item_texts(line_items, layout["line_items"]))
             continue
-        write_text_to_overlay(invoice_form[field], text, layout[field])
-
-    write_page_number(text, page_number, total_pages, layout)
+        texts.append((invoice_form[field], layout[field], 0))
+    texts.extend(generate_page_number_texts(page_number, total_pages, layout))
 
+    text = invoice_layer_canvas.beginText()
+    write_texts_to_overlay(texts, text)
     invoice_layer_canvas.drawText(text)
+    invoice_layer_canvas.showPage()
+
+
+def generate_invoice_overlays(
+    invoice_form: Dict[str, Union[str, List[Dict[str, str]]]],
+    layout: Dict[str, str],
+    line_item_lists: Iterable[List[Dict[str, str]]],
+    total_pages: int,
+) -> List[PageObject]:
+    """
+    Create the PDF pages (overlays) of invoice information, one for
+    each list of line items, that can be rendered on top of blank
+    invoice pages. All pages are drawn on a single canvas.
+
+    Arguments:
+    invoice_form -- data about the client passed from
+        the API end-point.
+    layout -- a dict containing information on position and style of text.
+    line_item_lists -- the line items to write on each page.
+    total_pages -- the number of lists in line_item_lists.
+    """
+    packet = io.BytesIO()
+    invoice_layer_canvas = canvas.Canvas(packet, pagesize=A4)
+
+    for page_number, line_item_list in enumerate(line_item_lists):
+        write_invoice_overlay_page(
+            invoice_layer_canvas,
+            invoice_form,
+            line_item_list,
+            layout,
+            page_number,
+            total_pages,
+        )
+
     invoice_layer_canvas.save()
     packet.seek(0)
-    return PdfFileReader(packet).getPage(0)
+    overlay_reader = PdfFileReader(packet)
+    return [overlay_reader.getPage(i) for i in range(total_pages)]
 
 
-def generate_line_item_lists(line_items: List[str]) -> List[List[str]]:
+# The number of line items that fit on one invoice page
+line_items_per_page = 10
+
+
+def count_invoice_pages(line_items: List[Dict[str, str]]) -> int:
     """
-    Takes a list of line items and splits it into
-    a list of sublists, such that each sublist contains
-    nine line items (enough to fill one invoice page).
+    Returns the number of pages needed to write a list of line items.
+
+    Arguments:
+        line_items -- the list of line items to write.
+    """
+    return math.ceil(len(line_items) / line_items_per_page)
+
+
+def generate_line_item_lists(
+    line_items: List[Dict[str, str]]
+) -> Iterator[List[Dict[str, str]]]:
+    """
+    Takes a list of line items and lazily splits it into
+    sublists, such that each sublist contains ten line
+    items (enough to fill one invoice page).
 
     Arguments:
         line_items -- the list of line items to split into sublists
     """
-    n = len(line_items)
-    return [line_items[j : j + 10] for j in range(0, n, 10)]
+    line_items_iterator = iter(line_items)
+    while True:
+        line_item_list = list(islice(line_items_iterator, line_items_per_page))
+        if not line_item_list:
+            return
+        yield line_item_list
 
 
 def generate_output_path(invoice_form: Dict[str, str]) -> str:
     """
     Takes in a dict representing the submitted form data
     and returns a string indicating where the generated
-    pdf should be saved.
+    pdf should be saved. Each invoice is saved in a new
+    directory of its own, so that invoices generated at the
+    same time for the same client and date do not overwrite
+    each other, while keeping the name of the file itself.
 
     Arguments:
         invoice_form -- the form data used to generate the invoice.
     """
-    output_path = (
-        "invoices/"
-        + "_".join(
+    file_name = (
+        "_".join(
             [
                 "Invoice_for",
                 invoice_form["first_name"],
@@ -363,13 +463,45 @@ def generate_output_path(invoice_form: Dict[str, str]) -> str:
         )
         + ".pdf"
     )
-    return generate_absolute_path(output_path)
+    invoice_dir = tempfile.mkdtemp(dir=generate_absolute_path("invoices"))
+    return os.path.join(invoice_dir, file_name)
+
+
+def remove_invoice(invoice_file_path: str) -> None:
+    """
+    Delete a saved invoice, along with the directory it was saved in
+    by generate_invoice.
+
+    Arguments:
+        invoice_file_path -- absolute path of the saved invoice.
+    """
+    os.remove(invoice_file_path)
+    os.rmdir(os.path.dirname(invoice_file_path))
 
 
+def scale_layout_to_points(layout: Dict[str, Union[str, Dict[str, str]]]) -> None:
+    """
+    Convert the x_origin and y_origin of every entry in a layout from
+    mm to points (the unit used by reportlab) in-place, so that this is
+    done once when the layout is read rather than for each text written.
+
+    Arguments:
+    layout -- the layout (or an entry in it) to convert.
+    """
+    for key, value in layout.items():
+        if isinstance(value, dict):
+            scale_layout_to_points(value)
+        elif key in ("x_origin", "y_origin"):
+            layout[key] = value * mm
+
+
+@lru_cache(maxsize=None)
 def read_layout_file(layout_name) -> Dict[str, Union[str, Dict[str, str]]]:
     """
     Read the layout file with the specified name and return the dict
-    loaded from the json therein.
+    loaded from the json therein, with positions converted from mm to
+    points. The file is only read the first time, so the returned dict
+    must not be modified.
 
     Arguments:
     layout_name -- the name of the layout to read.
@@ -377,9 +509,11 @@ def read_layout_file(layout_name) -> Dict[str, Union[str, Dict[str, str]]]:
     file_path = generate_absolute_path(f"/resources/layouts/{layout_name}.json")
     with open(file_path, "r") as layout_file:
         layout = load(layout_file)
+    scale_layout_to_points(layout)
     return layout
 
 
+@lru_cache(maxsize=None)
 def read_layout_fonts(layout_name: str) -> List[Dict[str, str]]:
     """
     Read the fonts associated with the layout being used.
@@ -393,12 +527,13 @@ def read_layout_fonts(layout_name: str) -> List[Dict[str, str]]:
     return fonts
 
 
+@lru_cache(maxsize=None)
 def read_layout_name() -> str:
     """
     Reads the name of the layout file to use for the company controlling
-    the instance of outvoice.
+    the instance of outvoice. The company file is only read the first time.
     """
-    file_path = generate_absolute_path(f"/resources/company/company.json")
+    file_path = generate_absolute_path("/resources/company/company.json")
     with open(file_path, "r") as company_file:
         layout_name = load(company_file)["layout_name"]
     return layout_name
@@ -406,36 +541,39 @@ def read_layout_name() -> str:
 
 def generate_invoice_pages(
     invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]
-) -> List[PageObject]:
+) -> Iterator[PageObject]:
     """
-    Returns a list of finished invoice pages (PageObjects).
+    Yields the finished invoice pages (PageObjects) in order, each
+    as soon as it has been merged.
 
     Arguments:
     invoice_form -- the form data used to generate the invoice.
     """
     page_template_path = generate_absolute_path("resources/templates/invoice.pdf")
     line_item_lists = generate_line_item_lists(invoice_form["line_items"])
+    total_pages = count_invoice_pages(invoice_form["line_items"])
     layout_name = read_layout_name()
     layout = read_layout_file(layout_name)
+    # Read the blank invoice once, each page is merged onto a copy of it
+    template_page = read_first_page(page_template_path)
 
-    invoice_pages = []
-    total_pages = len(line_item_lists)
-    for page_number, line_item_list in enumerate(line_item_lists):
-        invoice_form_copy = copy(invoice_form)
-        invoice_form_copy["line_items"] = line_item_list
-
-        # Read the blank invoice
-        invoice_page = read_first_page(page_template_path)
-        # Generate an overlay using client data
-        overlay = generate_invoice_overlay(
-            invoice_form_copy, layout, page_number, total_pages
-        )
+    # Generate an overlay for each page using client data
+    overlays = generate_invoice_overlays(
+        invoice_form, layout, line_item_lists, total_pages
+    )
+
+    for overlay in overlays:
+        # Copy the blank invoice
+        invoice_page = copy(template_page)
         # Merge the overlay on top of the blank invoice.
         invoice_page.mergePage(overlay)
-        # Add page to the finished invoice.
-        invoice_pages.append(invoice_page)
+        # Compress the merged content once, as it is about to be written.
+        invoice_page.compressContentStreams()
+        yield invoice_page
+
 
-    return invoice_pages
+# The size of the buffer used when writing a finished invoice (bytes)
+output_buffer_size = 1 << 20
 
 
 def generate_invoice(invoice_form: Dict[str, Union[str, List[Dict[str, str]]]]) -> str:
@@ -448,15 +586,19 @@ def generate_invoice(invoice_form: Dict[str, Union[str, List[Dict[str, str]]]])
     """
     output_path = generate_output_path(invoice_form)
 
-    # invoice is an object that stores all generated invoice pages.
-    invoice = PdfFileWriter()
-    format_invoice_form_input(invoice_form)
-    invoice_pages = generate_invoice_pages(invoice_form)
-    for i, invoice_page in enumerate(invoice_pages):
-        invoice.insertPage(invoice_page, i)
-    # Write the result
-    with open(output_path, "wb") as output_file:
-        invoice.write(output_file)
+    try:
+        # invoice is an object that stores all generated invoice pages.
+        invoice = PdfFileWriter()
+        format_invoice_form_input(invoice_form)
+        for invoice_page in generate_invoice_pages(invoice_form):
+            invoice.addPage(invoice_page)
+        # Write the result, buffering PyPDF2's many small writes into few syscalls
+        with open(output_path, "wb", buffering=output_buffer_size) as output_file:
+            invoice.write(output_file)
+    except Exception:
+        # Do not leave the invoice's directory (or a partly written invoice) behind
+        shutil.rmtree(os.path.dirname(output_path), ignore_errors=True)
+        raise
 
     return output_path
 
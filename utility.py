@@ -2,26 +2,8 @@ import os
 from datetime import datetime
 from typing import Optional
 
-
-def snake_to_camel(snake_str: str, lower_first: bool = True) -> str:
-    """
-    Returns a given snake_case string in camelCase (/ CamelCase).
-
-    Arguments:
-    snake_str -- string to convert from snake to camel case
-    lower_first -- bool to indicate if first character
-        should be upper case.
-    """
-
-    snake_str = snake_str.lower()
-
-    result = "".join(
-        word.capitalize() if i != 0 else word
-        for i, word in enumerate(snake_str.split("_"))
-    )
-    if not lower_first:
-        result = result.capitalize()
-    return result
+# The directory containing this script, resolved once at import.
+_PATH_TO_SCRIPT = os.path.dirname(os.path.abspath(__file__))
 
 
 def generate_absolute_path(relative_path: str) -> str:
@@ -31,8 +13,7 @@ def generate_absolute_path(relative_path: str) -> str:
     Arguments:
     relative_path -- path relative to current script.
     """
-    path_to_script = os.path.dirname(os.path.abspath(__file__))
-    return path_to_script + "/" + relative_path
+    return _PATH_TO_SCRIPT + "/" + relative_path
 
 
 def format_uk_date(date_to_format: str, separator: Optional[str] = "/") -> str:
@@ -44,5 +25,5 @@ def format_uk_date(date_to_format: str, separator: Optional[str] = "/") -> str:
     date_to_format -- the date to format, given as a string.
     separator -- the character used to separate the day, month and year
     """
-    date = datetime.strptime(date_to_format, "%Y-%m-%d")
-    return date.strftime(f"%d{separator}%m{separator}%Y")
+    d = datetime.strptime(date_to_format, "%Y-%m-%d")
+    return f"{d.day:02d}{separator}{d.month:02d}{separator}{d.year}"